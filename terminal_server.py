@@ -9,18 +9,25 @@ on Linux (including claude-desktop-debian) to bypass the wrapped sandbox safely.
 from __future__ import annotations
 
 import asyncio
+import atexit
+import functools
+import hashlib
 import json
 import os
 import re
 import shlex
 import signal
+import stat
+import struct
 import sys
+import threading
 import time
 import traceback
+from collections import deque
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
-from types import FrameType
-from typing import Any, Callable, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 
 import anyio
 try:
@@ -33,6 +40,16 @@ except ModuleNotFoundError:  # pragma: no cover - startup guard
     )
     raise
 
+try:
+    import orjson
+except ModuleNotFoundError:  # optional speedup for audit log serialization
+    orjson = None
+
+try:
+    import msgpack
+except ModuleNotFoundError:  # optional binary audit log format
+    msgpack = None
+
 # MCP imports (assumes mcp[cli] installed)
 from mcp.server.fastmcp import Context, FastMCP
 from mcp.server.fastmcp.exceptions import ToolError
@@ -43,7 +60,11 @@ LOG_DIR = ROOT_DIR / "logs"
 PERMISSION_CONFIG_PATH = ROOT_DIR / "permission_config.json"
 DEFAULT_SHELL = "/bin/bash"  # respects user rc files; no --norc/--noprofile
 DONE_SENTINEL = "__MCP_DONE__"
+# Appended to every command so its end shows up as a line ending in the sentinel.
+DONE_SUFFIX = f"\nprintf '{DONE_SENTINEL}\\n'\n"
+STREAM_BATCH_LINES = 64  # max output lines per ctx.info message
 EXPECTED_PYTHON = ROOT_DIR / ".venv" / "bin" / "python"
+AUDIT_FORMAT = os.environ.get("MCP_TERMINAL_AUDIT_FORMAT", "jsonl")  # or "msgpack"
 
 if EXPECTED_PYTHON.exists() and Path(sys.executable).resolve() != EXPECTED_PYTHON.resolve():
     sys.stderr.write(
@@ -51,6 +72,17 @@ if EXPECTED_PYTHON.exists() and Path(sys.executable).resolve() != EXPECTED_PYTHO
         "If dependencies are missing, restart Claude Desktop or configure it to use the venv python.\n"
     )
 
+if AUDIT_FORMAT not in ("jsonl", "msgpack"):
+    sys.stderr.write(
+        f"Terminal MCP warning: unknown MCP_TERMINAL_AUDIT_FORMAT={AUDIT_FORMAT!r} "
+        "(expected 'jsonl' or 'msgpack'); writing JSONL audit logs.\n"
+    )
+elif AUDIT_FORMAT == "msgpack" and msgpack is None:
+    sys.stderr.write(
+        "Terminal MCP warning: MCP_TERMINAL_AUDIT_FORMAT=msgpack but 'msgpack' is not "
+        "installed; writing JSONL audit logs.\n"
+    )
+
 
 DANGEROUS_PATTERNS: List[Tuple[str, str]] = [
     (r"&\s*$", "Backgrounding not supported"),
@@ -63,23 +95,45 @@ DANGEROUS_PATTERNS: List[Tuple[str, str]] = [
     (r"wget.*\|\s*(bash|sh)", "Download+execute blocked"),
 ]
 
+# All patterns fused into one alternation so a command is scanned in a single
+# regex call; the named group that matched indexes into _DANGEROUS_REASONS.
+_DANGEROUS_RE = re.compile(
+    "|".join(f"(?P<g{i}>{pattern})" for i, (pattern, _) in enumerate(DANGEROUS_PATTERNS))
+)
+_DANGEROUS_REASONS: Tuple[str, ...] = tuple(reason for _, reason in DANGEROUS_PATTERNS)
+
+# Literals at least one of which every DANGEROUS_PATTERNS match must contain
+# (the fork bomb and download+execute patterns all need "|"). A command with
+# none of them cannot match, so it skips the regex scan entirely.
+_DANGER_TOKENS: Tuple[str, ...] = ("&", "|", ">", "-rf", "of=/dev/")
+
 
 class SmartTimeout:
     """Adaptive timeout that resets on output and aborts long/idle runs."""
 
-    def __init__(self, initial_timeout: float = 30.0, max_timeout: float = 60.0):
+    def __init__(
+        self,
+        initial_timeout: float = 30.0,
+        max_timeout: float = 60.0,
+        granularity: float = 0.05,
+    ):
         self.initial_timeout = initial_timeout
         self.max_timeout = max_timeout
-        self.start_time = time.time()
-        self.last_output_time = time.time()
+        self.start_time = time.monotonic()
+        self.last_output_time = self.start_time
+        # Idle resets closer together than this are skipped; the timeouts are
+        # seconds long, so 50ms of slack is invisible.
+        self._granularity = granularity
 
     def saw_output(self) -> None:
         """Record that we saw output to reset the idle timer."""
-        self.last_output_time = time.time()
+        now = time.monotonic()
+        if now - self.last_output_time >= self._granularity:
+            self.last_output_time = now
 
     def check(self) -> Optional[str]:
         """Return a timeout reason if thresholds are exceeded."""
-        now = time.time()
+        now = time.monotonic()
         if now - self.start_time > self.max_timeout:
             return "max_timeout"
         if now - self.last_output_time > self.initial_timeout:
@@ -93,30 +147,74 @@ class PermissionBuckets:
     def __init__(self, path: Path):
         self.path = path
         self.buckets = self._load()
-
-    def _load(self) -> Dict[str, set]:
-        with open(self.path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return {k: set(v) for k, v in data.items()}
+        self._index = self._build_index(self.buckets)
+        self._last_digest: Optional[bytes] = None
+
+    def _load(self) -> Dict[str, frozenset]:
+        # Both parsers take bytes directly, skipping a text-mode decode pass.
+        raw = self.path.read_bytes()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        return {k: frozenset(v) for k, v in data.items()}
+
+    @staticmethod
+    def _build_index(buckets: Dict[str, frozenset]) -> Dict[str, str]:
+        """Map each command to its category; the first bucket listing it wins."""
+        index: Dict[str, str] = {}
+        for category, commands in buckets.items():
+            for cmd in commands:
+                index.setdefault(cmd, category)
+        return index
 
     def reload(self) -> None:
-        self.buckets = self._load()
+        buckets = self._load()
+        # Swap both together so classify never sees new buckets with an old index.
+        self.buckets, self._index = buckets, self._build_index(buckets)
+        self._last_digest = None  # file may have been edited externally
 
     def classify(self, base_cmd: str) -> str:
-        for category, commands in self.buckets.items():
-            if base_cmd in commands:
-                return category
-        return "always_ask"  # default to ask for uncategorized
+        return self._index.get(base_cmd, "always_ask")  # default to ask for uncategorized
 
     def move_ask_to_allow(self, base_cmd: str) -> None:
-        self.buckets.setdefault("always_ask", set()).discard(base_cmd)
-        self.buckets.setdefault("always_allow", set()).add(base_cmd)
+        # Buckets are frozensets: swap in new sets rather than mutating.
+        ask = self.buckets.get("always_ask", frozenset())
+        allow = self.buckets.get("always_allow", frozenset())
+        self.buckets["always_ask"] = ask - {base_cmd}
+        self.buckets["always_allow"] = allow | {base_cmd}
+        self._index = self._build_index(self.buckets)
         self._persist()
 
     def _persist(self) -> None:
         serializable = {k: sorted(list(v)) for k, v in self.buckets.items()}
-        with open(self.path, "w", encoding="utf-8") as f:
-            json.dump(serializable, f, indent=2)
+        new_bytes = json.dumps(serializable, indent=2).encode("utf-8")
+        digest = hashlib.blake2b(new_bytes, digest_size=8).digest()
+        if digest == self._last_digest:
+            return
+        # Write, fsync, then rename so a crash leaves either the old or the new
+        # config. Resolve first so a symlinked config keeps its link, and give
+        # the temp file the original's mode so the rename doesn't reset it.
+        target = self.path.resolve()
+        tmp = target.with_name(target.name + ".tmp")
+        try:
+            mode = stat.S_IMODE(target.stat().st_mode)
+        except FileNotFoundError:
+            mode = 0o644
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                os.fchmod(f.fileno(), mode)  # os.open's mode is masked by umask
+                f.write(new_bytes)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, target)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        dir_fd = os.open(target.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)  # make the rename itself durable
+        finally:
+            os.close(dir_fd)
+        self._last_digest = digest
 
 
 class PermissionOverrideManager:
@@ -126,7 +224,8 @@ class PermissionOverrideManager:
         self.rate_limit_seconds = rate_limit_seconds
         self.max_per_hour = max_per_hour
         self.session_allows: set[str] = set()
-        self.override_history: List[Dict[str, Any]] = []
+        # Oldest first; entries older than an hour are pruned on each read.
+        self.override_history: deque[Dict[str, Any]] = deque()
         self.last_override_time: float = 0.0
         self.override_count: int = 0
 
@@ -136,31 +235,80 @@ class PermissionOverrideManager:
             wait = self.rate_limit_seconds - (now - self.last_override_time)
             return False, f"Rate limited. Wait {wait:.0f}s"
 
-        hour_ago = now - 3600
-        recent = [o for o in self.override_history if o["timestamp"] > hour_ago]
-        if len(recent) >= self.max_per_hour:
+        self._prune(now)
+        if len(self.override_history) >= self.max_per_hour:
             return False, f"Hourly limit reached ({self.max_per_hour} overrides/hour)"
         return True, "OK"
 
-    def add_override(self, command: str, reason: str) -> None:
+    def _prune(self, now: float) -> None:
+        """Drop history entries older than an hour."""
+        hour_ago = now - 3600
+        history = self.override_history
+        while history and history[0]["timestamp"] <= hour_ago:
+            history.popleft()
+
+    def add_override(
+        self, command: str, reason: str, timestamp: Optional[float] = None
+    ) -> None:
+        now = time.time() if timestamp is None else timestamp
         self.override_history.append(
-            {"command": command, "reason": reason, "timestamp": time.time()}
+            {"command": command, "reason": reason, "timestamp": now}
         )
-        self.last_override_time = time.time()
+        self.last_override_time = now
         self.override_count += 1
         self.session_allows.add(_base_cmd(command))
 
 
 class AuditLogger:
-    """Append-only JSONL audit logs for commands, overrides, and errors."""
+    """Append-only JSONL audit logs for commands, overrides, and errors.
+
+    Entries are queued in memory and appended in batches by a background
+    flusher thread, so logging never touches the filesystem on the tool-call
+    path. A batch is flushed every ``FLUSH_INTERVAL`` seconds, or sooner once
+    it reaches ``FLUSH_ENTRIES`` entries or ``FLUSH_BYTES`` bytes.
+
+    With ``binary=True`` (and msgpack installed) entries are written to
+    ``*.msgpack`` files as MessagePack records, each prefixed with its 4-byte
+    big-endian length so a truncated tail can be detected and skipped::
+
+        import struct, msgpack
+
+        with open(path, "rb") as f:
+            while len(header := f.read(4)) == 4:
+                (size,) = struct.unpack(">I", header)
+                print(msgpack.unpackb(f.read(size), raw=False))
+    """
 
-    def __init__(self, log_dir: Path):
+    FLUSH_ENTRIES = 64
+    FLUSH_BYTES = 64 * 1024
+    FLUSH_INTERVAL = 0.25
+
+    def __init__(self, log_dir: Path, binary: bool = False):
+        # Falls back to JSONL when msgpack is not installed.
+        self.binary = binary and msgpack is not None
+        suffix = "msgpack" if self.binary else "log"
         timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-        self.command_log = log_dir / f"commands-{timestamp}.log"
-        self.override_log = log_dir / f"overrides-{timestamp}.log"
-        self.error_log = log_dir / f"errors-{timestamp}.log"
+        self.command_log = log_dir / f"commands-{timestamp}.{suffix}"
+        self.override_log = log_dir / f"overrides-{timestamp}.{suffix}"
+        self.error_log = log_dir / f"errors-{timestamp}.{suffix}"
         log_dir.mkdir(parents=True, exist_ok=True)
 
+        paths = (self.command_log, self.override_log, self.error_log)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[Path, List[bytes]] = {p: [] for p in paths}
+        self._pending_size: Dict[Path, int] = {p: 0 for p in paths}
+        # O_APPEND fds opened on first flush and kept for the life of the
+        # logger, so a run that never logs an override leaves no empty file.
+        self._fds: Dict[Path, int] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name="audit-log-flusher", daemon=True
+        )
+        self._flusher.start()
+        atexit.register(self.close)
+
     def log_command(self, entry: Dict[str, Any]) -> None:
         self._write(self.command_log, entry)
 
@@ -170,14 +318,117 @@ class AuditLogger:
     def log_error(self, entry: Dict[str, Any]) -> None:
         self._write(self.error_log, entry)
 
+    def flush(self) -> None:
+        """Append all queued entries to their log files."""
+        with self._flush_lock:
+            with self._lock:
+                batches = {p: b for p, b in self._pending.items() if b}
+                for path in batches:
+                    self._pending[path] = []
+                    self._pending_size[path] = 0
+            for path, lines in batches.items():
+                fd = self._fds.get(path)
+                if fd is None:
+                    fd = self._fds[path] = os.open(
+                        path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600
+                    )
+                buf = memoryview(b"".join(lines))
+                while buf:
+                    buf = buf[os.write(fd, buf) :]
+
+    def close(self) -> None:
+        """Stop the flusher, write any queued entries, and close the files."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._flusher.join()
+        self.flush()
+        with self._flush_lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+
+    def _encode(self, entry: Dict[str, Any]) -> bytes:
+        """Serialize one entry as a complete record, terminator included."""
+        if self.binary:
+            packed = msgpack.packb(entry, unicode_errors="surrogatepass")
+            return struct.pack(">I", len(packed)) + packed
+        if orjson is not None:
+            try:
+                return orjson.dumps(entry) + b"\n"
+            except TypeError:  # e.g. lone surrogates, which json escapes
+                pass
+        return json.dumps(entry, separators=(",", ":")).encode("ascii") + b"\n"
+
     def _write(self, path: Path, entry: Dict[str, Any]) -> None:
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(entry) + "\n")
+        line = self._encode(entry)
+        with self._lock:
+            batch = self._pending[path]
+            batch.append(line)
+            self._pending_size[path] += len(line)
+            full = (
+                len(batch) >= self.FLUSH_ENTRIES
+                or self._pending_size[path] >= self.FLUSH_BYTES
+            )
+        if full:
+            self._wake.set()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError as exc:
+                sys.stderr.write(f"Terminal MCP audit log write failed: {exc}\n")
+
+
+class BoundedOutput:
+    """Line buffer that keeps only the newest ``limit`` characters of output."""
+
+    TRUNCATED_MARKER = "...[truncated]..."
+
+    def __init__(self, limit: int = 256 * 1024):
+        self._limit = limit
+        self._chunks: deque[str] = deque()
+        self._size = 0
+        self.truncated = False
+
+    def append(self, line: str) -> None:
+        if len(line) > self._limit:
+            line = line[-self._limit :]
+            self.truncated = True
+        self._chunks.append(line)
+        self._size += len(line) + 1  # count the joining newline
+        while self._size > self._limit and len(self._chunks) > 1:
+            self._size -= len(self._chunks.popleft()) + 1
+            self.truncated = True
+
+    def finish(self) -> str:
+        """Join the retained lines, flagging dropped output with a marker."""
+        if self.truncated:
+            return "\n".join([self.TRUNCATED_MARKER, *self._chunks])
+        return "\n".join(self._chunks)
+
+
+class ExecutionState:
+    """Progress of one command across TerminalSession.execute_step calls."""
+
+    def __init__(self, timeout: SmartTimeout, output_limit: int):
+        self.timeout = timeout
+        self.output = BoundedOutput(output_limit)
+        self.partial = ""  # trailing text not yet terminated by a newline
 
 
 class TerminalSession:
     """Persistent pexpect-backed shell session (respects user rc files)."""
 
+    READ_SIZE = 4096  # bytes pulled from the PTY per read
+    READ_TIMEOUT = 0.5  # idle wait before re-checking the SmartTimeout
+    OUTPUT_LIMIT = 256 * 1024  # characters of output kept per command (newest)
+    INTERRUPT_GRACE = 2.0  # max seconds spent draining output after Ctrl+C
+
     def __init__(self, shell: str = DEFAULT_SHELL):
         self.shell_path = shell
         self._spawn_shell()
@@ -193,6 +444,82 @@ class TerminalSession:
             pass
         self._spawn_shell()
 
+    def start(self, command: str, timeout: Optional[SmartTimeout] = None) -> ExecutionState:
+        """Send a command to the shell; drive it to completion with execute_step."""
+        self.proc.sendline(command + DONE_SUFFIX)
+        return ExecutionState(timeout or SmartTimeout(), self.OUTPUT_LIMIT)
+
+    def execute_step(
+        self, state: ExecutionState
+    ) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+        """
+        Wait up to READ_TIMEOUT for output and consume what is available.
+        Returns (result, lines): result is the final dict (output, timeout info,
+        exit flags) once the command finished, timed out, or the shell died, and
+        None while it is still running; lines are the new output lines, already
+        stripped of their \\r\\n terminator.
+        """
+        try:
+            chunk = self.proc.read_nonblocking(
+                size=self.READ_SIZE, timeout=self.READ_TIMEOUT
+            )
+        except pexpect.EOF:
+            return {
+                "success": False,
+                "error": "Session terminated unexpectedly",
+                "output": state.output.finish(),
+            }, []
+        except pexpect.TIMEOUT:
+            return self._check_timeout(state), []
+
+        state.timeout.saw_output()
+        *raw_lines, partial = (state.partial + chunk).split("\n")
+        if len(partial) > self.OUTPUT_LIMIT:
+            # Output without newlines (progress bars, tr -d '\n') must not grow
+            # without bound either: keep the tail, which is where a sentinel lands.
+            partial = partial[-self.OUTPUT_LIMIT :]
+            state.output.truncated = True
+        state.partial = partial
+        lines: List[str] = []
+        for line in raw_lines:
+            line = line.rstrip("\r")
+            # The echoed printf ends in a quote, so only the real sentinel
+            # output can terminate a line with it.
+            done = line.endswith(DONE_SENTINEL)
+            if done:
+                line = line[: -len(DONE_SENTINEL)]
+            if line:
+                state.output.append(line)
+                lines.append(line)
+            if done:
+                return {"success": True, "output": state.output.finish()}, lines
+        # Also check while output keeps flowing, or chatty commands never hit
+        # max_timeout.
+        return self._check_timeout(state), lines
+
+    def _check_timeout(self, state: ExecutionState) -> Optional[Dict[str, Any]]:
+        """Interrupt the command and build its result if a timeout has expired."""
+        status = state.timeout.check()
+        if not status:
+            return None
+        self.proc.sendcontrol("c")
+        return {
+            "success": False,
+            "timeout": True,
+            "timeout_reason": status,
+            "output": state.output.finish(),
+        }
+
+    def interrupt(self) -> None:
+        """Send Ctrl+C and discard output until the shell goes quiet."""
+        self.proc.sendcontrol("c")
+        deadline = time.monotonic() + self.INTERRUPT_GRACE
+        try:
+            while time.monotonic() < deadline:
+                self.proc.read_nonblocking(size=self.READ_SIZE, timeout=self.READ_TIMEOUT)
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            pass
+
     def execute(
         self,
         command: str,
@@ -200,65 +527,46 @@ class TerminalSession:
         timeout: Optional[SmartTimeout] = None,
     ) -> Dict[str, Any]:
         """
-        Execute a command in the persistent shell.
-        Returns dict with output, timeout info, exit flags.
+        Execute a command in the persistent shell, blocking until it finishes.
+        Returns dict with output, timeout info, exit flags; the returned output
+        keeps only the newest OUTPUT_LIMIT characters.
         """
-        timeout = timeout or SmartTimeout()
-        wrapped = f"{command}\nprintf '{DONE_SENTINEL}\\n'\n"
-        output_lines: List[str] = []
-        self.proc.sendline(wrapped)
-
+        state = self.start(command, timeout)
         while True:
-            try:
-                idx = self.proc.expect(
-                    [rf"{DONE_SENTINEL}\r?\n", "\r\n", pexpect.EOF, pexpect.TIMEOUT],
-                    timeout=0.1,
-                )
-                if idx == 0:
-                    line = self.proc.before
-                    if line:
-                        output_lines.append(line)
-                        if stream_callback:
-                            stream_callback(line)
-                        timeout.saw_output()
-                    break
-                elif idx == 1:
-                    line = self.proc.before
-                    if line:
-                        output_lines.append(line)
-                        if stream_callback:
-                            stream_callback(line)
-                        timeout.saw_output()
-                elif idx == 2:  # EOF
-                    return {
-                        "success": False,
-                        "error": "Session terminated unexpectedly",
-                        "output": "\n".join(output_lines),
-                    }
-                elif idx == 3:  # TIMEOUT
-                    status = timeout.check()
-                    if status:
-                        self.proc.sendcontrol("c")
-                        return {
-                            "success": False,
-                            "timeout": True,
-                            "timeout_reason": status,
-                            "output": "\n".join(output_lines),
-                        }
-            except pexpect.TIMEOUT:
-                status = timeout.check()
-                if status:
-                    self.proc.sendcontrol("c")
-                    return {
-                        "success": False,
-                        "timeout": True,
-                        "timeout_reason": status,
-                        "output": "\n".join(output_lines),
-                    }
-        return {"success": True, "output": "\n".join(output_lines)}
+            result, lines = self.execute_step(state)
+            if stream_callback:
+                for line in lines:
+                    stream_callback(line)
+            if result is not None:
+                return result
+
 
+_iso_cache: Tuple[int, str] = (0, "")
 
+
+def _now_iso(ts: Optional[float] = None) -> str:
+    """Second-resolution ISO timestamp, formatted at most once per second."""
+    global _iso_cache
+    second = int(time.time() if ts is None else ts)
+    cached_second, cached = _iso_cache
+    if second != cached_second:
+        cached = datetime.fromtimestamp(second).isoformat(timespec="seconds")
+        _iso_cache = (second, cached)
+    return cached
+
+
+# shlex.split only breaks words on these, unlike str.split's Unicode whitespace.
+_SHLEX_WHITESPACE_CHARS = " \t\r\n"
+_SHLEX_WHITESPACE = re.compile(r"[ \t\r\n]+")
+
+
+@functools.lru_cache(maxsize=4096)
 def _base_cmd(command: str) -> str:
+    # Without quotes or escapes, shlex would just split on whitespace; only pay
+    # for the lexer when it could change the answer (or reject the command).
+    if "'" not in command and '"' not in command and "\\" not in command:
+        first = _SHLEX_WHITESPACE.split(command.lstrip(_SHLEX_WHITESPACE_CHARS), 1)[0]
+        return Path(first).name if first else ""
     try:
         parsed = shlex.split(command)
         if not parsed:
@@ -268,11 +576,15 @@ def _base_cmd(command: str) -> str:
         return ""
 
 
+@functools.lru_cache(maxsize=4096)
 def _match_dangerous(command: str) -> Optional[str]:
-    for pattern, reason in DANGEROUS_PATTERNS:
-        if re.search(pattern, command):
-            return reason
-    return None
+    if not any(token in command for token in _DANGER_TOKENS):
+        return None
+    match = _DANGEROUS_RE.search(command)
+    if match is None:
+        return None
+    # lastgroup is the outermost group that closed last, i.e. our g<i> wrapper.
+    return _DANGEROUS_REASONS[int(match.lastgroup[1:])]
 
 
 def _educational_block(command: str) -> str:
@@ -285,11 +597,81 @@ def _educational_block(command: str) -> str:
     )
 
 
-server = FastMCP(name="terminal-mcp")
+def _reload_permissions() -> None:
+    """SIGHUP handler (runs on the event loop) to reload permissions from disk."""
+    try:
+        permissions.reload()
+    except Exception as exc:  # keep serving with the previous buckets
+        audit_logger.log_error(
+            {
+                "timestamp": _now_iso(),
+                "error": f"Permission reload failed: {exc}",
+                "traceback": traceback.format_exc(),
+            }
+        )
+
+
+def _sighup_outside_loop(signum: int, frame: Any) -> None:
+    """SIGHUP while no server session runs: no tool call can race the reload."""
+    _reload_permissions()
+
+
+_previous_sigterm: Any = signal.SIG_DFL
+
+
+def _terminate() -> None:
+    """SIGTERM on the server loop: write out queued audit entries, then pass the
+    signal on to whatever handled it before (e.g. uvicorn's graceful shutdown)."""
+    previous = _previous_sigterm
+    if callable(previous):
+        audit_logger.flush()  # keep logging: the server still winds down
+        previous(signal.SIGTERM, None)
+    elif previous == signal.SIG_IGN:
+        audit_logger.flush()
+    else:
+        audit_logger.close()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+_active_lifespans = 0
+
+
+@asynccontextmanager
+async def _lifespan(app: FastMCP) -> AsyncIterator[Dict[str, Any]]:
+    """Handle SIGHUP (reload) and SIGTERM (flush audit logs) on the server loop.
+
+    FastMCP enters this once per session (SSE/HTTP may run several at once),
+    so the loop handlers are installed by the first and removed by the last.
+    """
+    global _active_lifespans, _previous_sigterm
+    loop = asyncio.get_running_loop()
+    if _active_lifespans == 0:
+        loop.add_signal_handler(signal.SIGHUP, _reload_permissions)
+        # None means a handler not installed from Python; treat it as default.
+        _previous_sigterm = signal.getsignal(signal.SIGTERM) or signal.SIG_DFL
+        loop.add_signal_handler(signal.SIGTERM, _terminate)
+    _active_lifespans += 1
+    try:
+        yield {}
+    finally:
+        _active_lifespans -= 1
+        if _active_lifespans == 0:
+            # remove_signal_handler resets SIGHUP to SIG_DFL, which would kill us.
+            loop.remove_signal_handler(signal.SIGHUP)
+            signal.signal(signal.SIGHUP, _sighup_outside_loop)
+            # Likewise SIGTERM: put back the previous handler (uvicorn's, say).
+            loop.remove_signal_handler(signal.SIGTERM)
+            signal.signal(signal.SIGTERM, _previous_sigterm)
+            audit_logger.flush()  # a default SIGTERM from here on skips atexit
+
+
+server = FastMCP(name="terminal-mcp", lifespan=_lifespan)
 permissions = PermissionBuckets(PERMISSION_CONFIG_PATH)
 override_manager = PermissionOverrideManager()
-audit_logger = AuditLogger(LOG_DIR)
+audit_logger = AuditLogger(LOG_DIR, binary=AUDIT_FORMAT == "msgpack")
 session: Optional[TerminalSession] = None
+signal.signal(signal.SIGHUP, _sighup_outside_loop)
 
 
 def _get_session() -> TerminalSession:
@@ -300,12 +682,13 @@ def _get_session() -> TerminalSession:
     return session
 
 
-def _reload_permissions(signum: int, frame: Optional[FrameType]) -> None:
-    """SIGHUP handler to reload permissions from disk."""
-    permissions.reload()
-
-
-signal.signal(signal.SIGHUP, _reload_permissions)
+# category -> (allowed?, category, message); a None message means "explain the
+# block for this command" and is filled in by _check_permission.
+_PERMISSION_DISPATCH: Dict[str, Tuple[bool, str, Optional[str]]] = {
+    "always_allow": (True, "always_allow", "Allowed"),
+    "always_block": (False, "always_block", None),
+    "always_ask": (False, "always_ask", "Permission required"),
+}
 
 
 def _check_permission(command: str) -> Tuple[bool, str, str]:
@@ -317,15 +700,13 @@ def _check_permission(command: str) -> Tuple[bool, str, str]:
     if base in override_manager.session_allows:
         return True, "session_allowed", "Session override"
 
-    category = permissions.classify(base)
-    if category == "always_block":
-        return False, category, _educational_block(base)
-    if category == "always_allow":
-        return True, category, "Allowed"
-    if category == "always_ask":
-        return False, category, "Permission required"
-    # default
-    return False, "always_ask", "Permission required"
+    # Unknown categories from a hand-edited config default to ask.
+    allowed, category, message = _PERMISSION_DISPATCH.get(
+        permissions.classify(base), _PERMISSION_DISPATCH["always_ask"]
+    )
+    if message is None:
+        return allowed, category, _educational_block(base)
+    return allowed, category, message
 
 
 async def _execute_internal(
@@ -338,26 +719,38 @@ async def _execute_internal(
     if dangerous:
         raise ToolError(f"Blocked: {dangerous}")
 
-    loop = asyncio.get_running_loop()
     sess = _get_session()
-
-    def stream_cb(line: str) -> None:
-        if ctx:
-            try:
-                loop.call_soon_threadsafe(
-                    asyncio.create_task, ctx.info(line.rstrip("\r\n"))
-                )
-            except Exception:
-                pass
-
     try:
-        result = await anyio.to_thread.run_sync(
-            sess.execute, command, stream_cb, SmartTimeout()
+        state = sess.start(command, SmartTimeout())
+        result: Optional[Dict[str, Any]] = None
+        while result is None:
+            # Each step blocks a worker thread for at most READ_TIMEOUT, so a
+            # long command never pins one and cancellation is noticed promptly.
+            result, lines = await anyio.to_thread.run_sync(sess.execute_step, state)
+            if ctx:
+                for i in range(0, len(lines), STREAM_BATCH_LINES):
+                    try:
+                        await ctx.info("\n".join(lines[i : i + STREAM_BATCH_LINES]))
+                    except Exception:
+                        pass
+    except anyio.get_cancelled_exc_class():
+        # Client went away: stop the command so the shell is ready for the next one.
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(sess.interrupt)
+        audit_logger.log_command(
+            {
+                "timestamp": _now_iso(),
+                "command": command,
+                "success": False,
+                "is_override": is_override,
+                "cancelled": True,
+            }
         )
+        raise
     except Exception as exc:
         audit_logger.log_error(
             {
-                "timestamp": datetime.now().isoformat(),
+                "timestamp": _now_iso(),
                 "command": command,
                 "error": str(exc),
                 "traceback": traceback.format_exc(),
@@ -371,7 +764,7 @@ async def _execute_internal(
         raise ToolError(str(exc)) from exc
     audit_logger.log_command(
         {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": _now_iso(),
             "command": command,
             "success": result.get("success"),
             "is_override": is_override,
@@ -415,10 +808,11 @@ async def execute_with_override(
     if not allowed:
         raise ToolError(msg)
 
-    override_manager.add_override(command, safety_override_reason)
+    now = time.time()
+    override_manager.add_override(command, safety_override_reason, timestamp=now)
     audit_logger.log_override(
         {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": _now_iso(now),
             "command": command,
             "reason": safety_override_reason,
             "override_count": override_manager.override_count,
@@ -491,8 +885,9 @@ async def reset_session() -> Dict[str, Any]:
 
 @server.tool()
 async def view_override_history() -> Dict[str, Any]:
-    """Return the in-memory override history for this process."""
-    return {"overrides": override_manager.override_history}
+    """Return the in-memory override history (last hour) for this process."""
+    override_manager._prune(time.time())
+    return {"overrides": list(override_manager.override_history)}
 
 
 def run() -> None:
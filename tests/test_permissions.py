@@ -1,16 +1,26 @@
 import json
+import os
+import signal
+import time
+from collections import deque
 from pathlib import Path
 
+import anyio
 import pytest
 
+import terminal_server
 from terminal_server import (
     DANGEROUS_PATTERNS,
+    AuditLogger,
+    BoundedOutput,
     PermissionBuckets,
     PermissionOverrideManager,
     SmartTimeout,
     TerminalSession,
     ToolError,
     _base_cmd,
+    _check_permission,
+    _execute_internal,
     _match_dangerous,
     execute_with_override,
     user_approve_command,
@@ -22,10 +32,45 @@ def anyio_backend():
     return "asyncio"
 
 
+@pytest.fixture
+def shell():
+    """A fresh TerminalSession whose rc files have finished loading."""
+    try:
+        session = TerminalSession()
+    except OSError as exc:
+        pytest.skip(f"PTY not available: {exc}")
+    session.proc.setecho(False)
+    try:
+        # Slow rc files (e.g. conda init) must not eat into a test's timeout.
+        session.execute("true", timeout=SmartTimeout(initial_timeout=30, max_timeout=30))
+        yield session
+    finally:
+        session.proc.close(force=True)
+
+
+@pytest.fixture
+def server_shell(shell, monkeypatch, tmp_path):
+    """Point the server module at ``shell`` and a throwaway audit logger."""
+    logger = AuditLogger(tmp_path)
+    monkeypatch.setattr(terminal_server, "session", shell)
+    monkeypatch.setattr(terminal_server, "audit_logger", logger)
+    try:
+        yield shell, logger
+    finally:
+        logger.close()
+
+
 def test_base_cmd_parsing():
     assert _base_cmd("ls -la /tmp") == "ls"
     assert _base_cmd("/usr/bin/rm -rf /") == "rm"
     assert _base_cmd("") == ""
+    assert _base_cmd("  \tpwd") == "pwd"
+    assert _base_cmd("'/opt/my tools/run' --flag") == "run"
+    assert _base_cmd('echo "unterminated') == ""
+    assert _base_cmd("\x0bls") == "\x0bls"  # only space/tab/CR/LF split words
+    assert _base_cmd("ls\x0cfoo") == "ls\x0cfoo"
+    assert _base_cmd(". ./script.sh") == ""
+    assert _base_cmd("/usr/bin/ls/") == "ls"
 
 
 def test_permission_buckets_reload(tmp_path):
@@ -45,6 +90,50 @@ def test_permission_buckets_reload(tmp_path):
 
     buckets.move_ask_to_allow("rm")
     assert buckets.classify("rm") == "always_allow"
+    assert json.loads(cfg.read_text(encoding="utf-8"))["always_allow"] == ["ls", "rm"]
+    assert not cfg.with_suffix(".json.tmp").exists()
+
+    mtime = cfg.stat().st_mtime_ns
+    buckets.move_ask_to_allow("rm")  # no-op approval does not rewrite
+    assert cfg.stat().st_mtime_ns == mtime
+
+    cfg.write_text(json.dumps({"always_block": ["ls"]}), encoding="utf-8")
+    buckets.reload()
+    assert buckets.classify("ls") == "always_block"
+    assert buckets.classify("rm") == "always_ask"
+
+
+def test_check_permission_categories(monkeypatch, tmp_path):
+    cfg = tmp_path / "perm.json"
+    data = {"always_allow": ["ls"], "always_block": ["vim"], "custom": ["make"]}
+    cfg.write_text(json.dumps(data), encoding="utf-8")
+    monkeypatch.setattr(terminal_server, "permissions", PermissionBuckets(cfg))
+    monkeypatch.setattr(terminal_server, "override_manager", PermissionOverrideManager())
+
+    assert _check_permission("ls -la") == (True, "always_allow", "Allowed")
+    allowed, category, message = _check_permission("vim notes.txt")
+    assert (allowed, category) == (False, "always_block") and "vim" in message
+    assert _check_permission("rm x") == (False, "always_ask", "Permission required")
+    assert _check_permission("make") == (False, "always_ask", "Permission required")
+    assert _check_permission("   ") == (False, "always_ask", "Empty command")
+
+    terminal_server.override_manager.session_allows.add("rm")
+    assert _check_permission("rm x") == (True, "session_allowed", "Session override")
+
+
+def test_permission_persist_keeps_mode_and_symlink(tmp_path):
+    real = tmp_path / "real.json"
+    real.write_text(json.dumps({"always_ask": ["rm"]}), encoding="utf-8")
+    real.chmod(0o640)
+    link = tmp_path / "perm.json"
+    link.symlink_to(real)
+
+    PermissionBuckets(link).move_ask_to_allow("rm")
+
+    assert link.is_symlink()
+    assert json.loads(real.read_text(encoding="utf-8"))["always_allow"] == ["rm"]
+    assert real.stat().st_mode & 0o777 == 0o640
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["perm.json", "real.json"]
 
 
 def test_dangerous_pattern_detection():
@@ -52,6 +141,24 @@ def test_dangerous_pattern_detection():
     assert _match_dangerous("echo hello") is None
 
 
+@pytest.mark.parametrize(
+    "command, reason",
+    [
+        ("sleep 10 &", "Backgrounding not supported"),
+        ("echo id | sh", "Piping to shells is blocked"),
+        ("echo x > /dev/null", "Dangerous redirection to devices"),
+        (":(){ :|:& };:", "Fork bomb pattern"),
+        ("dd if=img of=/dev/sda", "Direct disk write attempt"),
+        ("rm\t-rf /", "Recursive delete from root is blocked"),
+        ("sleep 3 &\x1c", "Backgrounding not supported"),
+        ("echo id |\xa0sh", "Piping to shells is blocked"),
+        ("c-dc&u/&(ef.g|b&\t", "Backgrounding not supported"),
+    ],
+)
+def test_dangerous_pattern_reasons(command, reason):
+    assert _match_dangerous.__wrapped__(command) == reason
+
+
 def test_override_rate_limits():
     mgr = PermissionOverrideManager(rate_limit_seconds=1, max_per_hour=2)
     allowed, _ = mgr.check_rate_limit()
@@ -62,32 +169,228 @@ def test_override_rate_limits():
     assert not allowed and "Rate limited" in msg
 
     # Simulate two overrides within an hour
-    mgr.override_history = [
-        {"timestamp": mgr.last_override_time},
-        {"timestamp": mgr.last_override_time - 10},
-    ]
+    mgr.override_history = deque(
+        [
+            {"timestamp": mgr.last_override_time - 4000},  # expired, pruned
+            {"timestamp": mgr.last_override_time - 10},
+            {"timestamp": mgr.last_override_time},
+        ]
+    )
     mgr.last_override_time -= 3600  # bypass short-term rate limit for this check
     allowed, msg = mgr.check_rate_limit()
     assert not allowed and "Hourly limit" in msg
+    assert len(mgr.override_history) == 2
+
 
+def test_smart_timeout_thresholds():
+    timeout = SmartTimeout(initial_timeout=30, max_timeout=60)
+    assert timeout.check() is None
+    timeout.start_time -= 61
+    assert timeout.check() == "max_timeout"
 
-def test_terminal_session_captures_trailing_output_without_newline():
+    timeout = SmartTimeout(initial_timeout=30, max_timeout=60)
+    timeout.last_output_time -= 31
+    assert timeout.check() == "output_timeout"
+    timeout.saw_output()
+    assert timeout.check() is None
+
+
+def test_audit_logger_batches_until_flush(tmp_path):
+    logger = AuditLogger(tmp_path)
     try:
-        session = TerminalSession()
-    except OSError as exc:
-        pytest.skip(f"PTY not available: {exc}")
-    session.proc.setecho(False)
+        logger.log_command({"command": "ls"})
+        logger.log_command({"command": "pwd"})
+        logger.flush()
+        lines = logger.command_log.read_text(encoding="utf-8").splitlines()
+        assert [json.loads(line)["command"] for line in lines] == ["ls", "pwd"]
+        assert not logger.override_log.exists()  # nothing logged, no file
+        assert logger.command_log.stat().st_mode & 0o777 == 0o600
+    finally:
+        logger.close()
+
+
+def test_bounded_output_keeps_newest_lines():
+    output = BoundedOutput(limit=10)
+    output.append("abc")
+    output.append("def")
+    assert output.finish() == "abc\ndef"
+
+    output.append("ghij")
+    assert output.finish() == "...[truncated]...\ndef\nghij"
+
+    output.append("x" * 25)
+    assert output.finish() == "...[truncated]...\n" + "x" * 10
+
+
+def test_audit_logger_binary_records(tmp_path):
+    msgpack = pytest.importorskip("msgpack")
+    logger = AuditLogger(tmp_path, binary=True)
     try:
-        result = session.execute(
-            "printf '__PAYLOAD__'", timeout=SmartTimeout(initial_timeout=2, max_timeout=2)
-        )
+        logger.log_error({"command": "ls", "error": "boom"})
+        logger.log_error({"command": "pwd", "error": "bang"})
+        logger.flush()
+        data = logger.error_log.read_bytes()
     finally:
-        session.proc.close(force=True)
+        logger.close()
+
+    assert logger.error_log.suffix == ".msgpack"
+    records = []
+    while data:
+        size = int.from_bytes(data[:4], "big")
+        records.append(msgpack.unpackb(data[4 : 4 + size], raw=False))
+        data = data[4 + size :]
+    assert [r["command"] for r in records] == ["ls", "pwd"]
+
+
+def test_terminal_session_captures_trailing_output_without_newline(shell):
+    result = shell.execute(
+        "printf '__PAYLOAD__'", timeout=SmartTimeout(initial_timeout=2, max_timeout=2)
+    )
 
     assert result["success"] is True
     assert "__PAYLOAD__" in result["output"]
 
 
+def test_terminal_session_enforces_max_timeout_while_output_flows(shell):
+    started = time.monotonic()
+    result = shell.execute(
+        "for i in $(seq 1 40); do echo tick; sleep 0.2; done",
+        timeout=SmartTimeout(initial_timeout=5, max_timeout=2),
+    )
+
+    assert result["success"] is False
+    assert result["timeout_reason"] == "max_timeout"
+    assert "tick" in result["output"]
+    assert time.monotonic() - started < 5
+
+
+def test_terminal_session_caps_output_without_newlines(shell):
+    shell.OUTPUT_LIMIT = 1000
+    state = shell.start("head -c 50000 /dev/zero | tr '\\0' x")
+    result = None
+    while result is None:
+        result, _ = shell.execute_step(state)
+        assert len(state.partial) <= 1000
+
+    assert result["success"] is True
+    marker, _, tail = result["output"].partition("\n")
+    assert marker == "...[truncated]..."
+    assert len(tail) <= 1000 and "x" * 100 in tail
+
+
+class _RecordingContext:
+    def __init__(self):
+        self.messages = []
+
+    async def info(self, message):
+        self.messages.append(message)
+
+    async def error(self, message):
+        self.messages.append(message)
+
+
+@pytest.mark.anyio("asyncio")
+async def test_execute_internal_streams_output_in_batches(server_shell):
+    ctx = _RecordingContext()
+    result = await _execute_internal("seq 1 200", ctx)
+
+    assert result["success"] is True
+    streamed = "\n".join(ctx.messages).splitlines()
+    assert [line for line in streamed if line.isdigit()] == [str(i) for i in range(1, 201)]
+    assert len(ctx.messages) < 200
+
+
+@pytest.mark.anyio("asyncio")
+async def test_execute_internal_interrupts_command_on_cancel(server_shell):
+    session, logger = server_shell
+    with anyio.move_on_after(3):
+        await _execute_internal("sleep 30", None)
+    result = session.execute(
+        "echo __AFTER__", timeout=SmartTimeout(initial_timeout=5, max_timeout=5)
+    )
+    logger.flush()
+    entry = json.loads(logger.command_log.read_text(encoding="utf-8"))
+
+    assert result["success"] is True
+    assert "__AFTER__" in result["output"]
+    assert entry["command"] == "sleep 30" and entry["cancelled"] is True
+
+
+@pytest.mark.anyio("asyncio")
+async def test_sighup_reloads_permissions_on_server_loop(monkeypatch, tmp_path):
+    cfg = tmp_path / "perm.json"
+    cfg.write_text(json.dumps({"always_allow": ["ls"]}), encoding="utf-8")
+    buckets = PermissionBuckets(cfg)
+    monkeypatch.setattr(terminal_server, "permissions", buckets)
+
+    async def reload_to(category):
+        cfg.write_text(json.dumps({category: ["ls"]}), encoding="utf-8")
+        os.kill(os.getpid(), signal.SIGHUP)
+        with anyio.fail_after(2):
+            while buckets.classify("ls") != category:
+                await anyio.sleep(0.01)
+
+    lifespan = terminal_server._lifespan
+    async with lifespan(terminal_server.server):
+        async with lifespan(terminal_server.server):
+            await reload_to("always_block")
+        await reload_to("always_ask")  # another session ending keeps the handler
+    await reload_to("always_allow")  # no session running: still reloads, no kill
+
+
+def test_sigterm_flushes_queued_audit_entries(monkeypatch, tmp_path):
+    logger = AuditLogger(tmp_path)
+    kills = []
+    monkeypatch.setattr(terminal_server, "audit_logger", logger)
+    monkeypatch.setattr(terminal_server.os, "kill", lambda pid, sig: kills.append(sig))
+    logger.log_command({"command": "ls"})
+
+    terminal_server._terminate()
+
+    assert json.loads(logger.command_log.read_text(encoding="utf-8")) == {"command": "ls"}
+    assert kills == [signal.SIGTERM]
+
+
+@pytest.mark.anyio("asyncio")
+async def test_lifespan_chains_and_restores_previous_sigterm_handler(
+    monkeypatch, tmp_path
+):
+    received = []
+
+    def sentinel(signum, frame):
+        received.append(signum)
+
+    logger = AuditLogger(tmp_path)
+    monkeypatch.setattr(terminal_server, "audit_logger", logger)
+    original = signal.signal(signal.SIGTERM, sentinel)
+    try:
+        async with terminal_server._lifespan(terminal_server.server):
+            logger.log_command({"command": "ls"})
+            os.kill(os.getpid(), signal.SIGTERM)
+            with anyio.fail_after(2):
+                while not received:
+                    await anyio.sleep(0.01)
+            assert logger.command_log.exists()  # flushed before handing off
+        assert signal.getsignal(signal.SIGTERM) is sentinel
+    finally:
+        signal.signal(signal.SIGTERM, original)
+        logger.close()
+
+    assert received == [signal.SIGTERM]
+
+
+@pytest.mark.anyio("asyncio")
+async def test_view_override_history_drops_entries_older_than_an_hour(monkeypatch):
+    mgr = PermissionOverrideManager()
+    now = time.time()
+    mgr.add_override("rm old", "x" * 60, timestamp=now - 3 * 3600)
+    mgr.add_override("rm new", "x" * 60, timestamp=now - 10)
+    monkeypatch.setattr(terminal_server, "override_manager", mgr)
+
+    result = await terminal_server.view_override_history()
+    assert [entry["command"] for entry in result["overrides"]] == ["rm new"]
+
+
 @pytest.mark.anyio("asyncio")
 async def test_execute_with_override_rejects_empty_command():
     with pytest.raises(ToolError):